@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+
+import hashlib
+import logging
+import os
+import pickle
+import tempfile
+
+
+def digest(*parts):
+    """Returns a hex digest of parts
+
+    Parameters:
+        parts: strings, numbers, None, or (nested) lists or tuples thereof
+    """
+    return hashlib.sha256(repr(parts).encode("utf-8")).hexdigest()
+
+
+def file_digest(fname):
+    """Returns a hex digest of the contents of a file"""
+    h = hashlib.sha256()
+    with open(fname, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def stat_digest(fname):
+    """Returns a hex digest of the path, size and modification time of a file
+
+    Much cheaper than file_digest() for large files, such as videos.
+    """
+    st = os.stat(fname)
+    return digest(os.path.abspath(fname), st.st_size, st.st_mtime_ns)
+
+
+class Cache:
+    """A content-addressed store of stage results
+
+    Each stage is identified by a key: a digest of its name and inputs. A stage
+    that depends on another stage includes that stage's key in its inputs, so
+    the stages form a dependency graph in which a change to an input changes
+    the keys of exactly the stages downstream of it. Everything upstream is
+    found in the cache.
+
+    Results are kept in memory (pickled, so every caller gets its own copy to
+    mutate) and, if a directory is given, on disk so they survive between runs.
+
+    The code that computes the results is an input to every stage as well:
+    results computed by an older version of one of the code files are not
+    reused.
+    """
+
+    def __init__(self, directory=None, code=()):
+        self.directory = directory
+        self.version = digest([file_digest(fname) for fname in code])
+        self.memory = {}
+        self.used = set()
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def stage(self, name, inputs, compute, fresh=False):
+        """Returns the result of a stage, computing it only if necessary
+
+        Parameters:
+            name (string): the name of the stage
+            inputs (list): everything the result depends on, see digest()
+            compute (callable): computes the result
+            fresh (bool): compute the result even if it is cached, e.g.,
+                          because compute has a side effect
+
+        Returns:
+            [result, key] tuple
+        """
+        key = digest(name, inputs, self.version)
+        self.used.add(key)
+
+        if fresh:
+            self.memory.pop(key, None)
+
+        path = None
+        if self.directory:
+            path = os.path.join(self.directory, key + ".pickle")
+            if key not in self.memory and not fresh and os.path.isfile(path):
+                with open(path, "rb") as f:
+                    self.memory[key] = f.read()
+
+        if key in self.memory:
+            logging.info("Reusing cached %s stage %s", name, key[:12])
+            return pickle.loads(self.memory[key]), key
+
+        result = compute()
+        self.memory[key] = pickle.dumps(result, pickle.HIGHEST_PROTOCOL)
+
+        if path:
+            # write atomically; a half-written file would poison later runs
+            fd, tmpname = tempfile.mkstemp(dir=self.directory)
+            with os.fdopen(fd, "wb") as f:
+                f.write(self.memory[key])
+            os.replace(tmpname, path)
+
+        return result, key
+
+    def sweep(self):
+        """Drops in-memory results that were not used since the previous sweep"""
+        self.memory = {k: v for k, v in self.memory.items() if k in self.used}
+        self.used = set()
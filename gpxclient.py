@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+
+import json
+import os
+import socket
+import stat
+import struct
+import sys
+
+ENVVAR_SOCKET = "GPXD_SOCKET"
+ENVVAR_DISABLE = "GPXD_DISABLE"
+
+
+def socket_path():
+    """Returns the path of the Unix socket gpxd listens on
+
+    That is $GPXD_SOCKET if set, else gpxd.sock in $XDG_RUNTIME_DIR (which
+    only the user can write to) if set, else /tmp/gpxd-<uid>.sock.
+    """
+    if os.environ.get(ENVVAR_SOCKET):
+        return os.environ[ENVVAR_SOCKET]
+    if os.environ.get("XDG_RUNTIME_DIR"):
+        return os.path.join(os.environ["XDG_RUNTIME_DIR"], "gpxd.sock")
+    return os.path.join("/tmp", "gpxd-%d.sock" % (os.getuid()))
+
+
+def owned(path):
+    """Returns True if path is a Unix socket that belongs to the current user
+
+    Anyone can create a socket in /tmp, including at the path a user's gpxd
+    would listen on, so a socket that belongs to someone else must never be
+    trusted with a command line and standard input, nor with the output.
+    """
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return False
+    return stat.S_ISSOCK(st.st_mode) and st.st_uid == os.getuid()
+
+
+def peer_uid(sock):
+    """Returns the user id of the process on the other end of a Unix socket
+
+    Returns None where the operating system does not tell (SO_PEERCRED is
+    Linux only).
+    """
+    if not hasattr(socket, "SO_PEERCRED"):
+        return None
+    creds = sock.getsockopt(
+        socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i")
+    )
+    _, uid, _ = struct.unpack("3i", creds)
+    return uid
+
+
+def forward(fname):
+    """Runs a gpx* tool in gpxd, if gpxd is running
+
+    Parameters:
+        fname (string): the tool's __file__
+
+    If gpxd is listening on socket_path(), this sends it the tool's name, the
+    command line arguments and the current directory, sends standard input if
+    the tool reads it, copies what the tool writes to stdout and stderr as it
+    arrives, and exits with the tool's exit code. Otherwise, or if GPXD_DISABLE
+    is set, it returns and the tool runs in-process as usual.
+
+    It does the same, with a warning, if the socket or the gpxd listening on
+    it belongs to another user; see owned().
+
+    This module only uses the standard library, so a tool can call it before
+    importing gpxlib and its (slow to import) dependencies.
+    """
+    if os.environ.get(ENVVAR_DISABLE):
+        return
+
+    path = socket_path()
+    if not os.path.lexists(path):
+        return
+    if not owned(path):
+        print("gpxd: ignoring %s, which is not yours" % (path), file=sys.stderr)
+        return
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError:
+        sock.close()
+        return
+
+    uid = peer_uid(sock)
+    if uid is not None and uid != os.getuid():
+        sock.close()
+        print(
+            "gpxd: ignoring %s, which is served by user %d" % (path, uid),
+            file=sys.stderr,
+        )
+        return
+
+    request = {
+        "tool": os.path.basename(fname),
+        "argv": sys.argv[1:],
+        "cwd": os.getcwd(),
+    }
+
+    with sock, sock.makefile("rw", encoding="utf-8") as f:
+        f.write(json.dumps(request) + "\n")
+        f.flush()
+
+        for line in f:
+            response = json.loads(line)
+            if "exit" in response:
+                sys.exit(response["exit"])
+            if "read" in response:
+                f.write(json.dumps({"stdin": sys.stdin.read()}) + "\n")
+                f.flush()
+                continue
+            stream = sys.stderr if response["fd"] == 2 else sys.stdout
+            stream.write(response["data"])
+            stream.flush()
+
+    sys.exit("gpxd closed the connection")
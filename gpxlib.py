@@ -1,14 +1,22 @@
 #!/usr/bin/env python
 
+import contextlib
 import copy
+import json
 import logging
 import math
+import os
+import pickle
 import sys
-from datetime import datetime, timedelta
+import time as timer
+from collections import OrderedDict
+from datetime import timedelta
+from xml.sax.saxutils import escape
 
 import dateparser
 import geopy.distance
 import gpxpy
+import numpy as np
 from dateutil import tz
 from timezonefinder import TimezoneFinder
 
@@ -38,6 +46,52 @@ def create(gpx=None):
     return gpx_out, gpx_segment
 
 
+LEAN_PRECISION = 6  # decimals; about 0.1 meter
+
+
+def to_xml(gpx, lean=False, precision=LEAN_PRECISION):
+    """Serializes GPX data
+
+    Parameters:
+        gpx (gpxpy.gpx.GPX): GPX data
+        lean (bool): only write what GPX Animator uses
+        precision (int): with lean, the number of decimals of lat and lon
+
+    Returns:
+        A string with GPX XML
+
+    gpxpy writes everything it knows about every point (elevation, speed,
+    extensions, namespaces, floats at full precision). The lean output is a
+    single track segment whose points only have lat, lon, time (in UTC, to the
+    millisecond) and <cmt>, which is all GPX Animator reads. It is a fraction
+    of the size and quicker for GPX Animator to parse.
+    """
+    if not lean:
+        return gpx.to_xml()
+
+    trkpt = '<trkpt lat="%%.%df" lon="%%.%df">' % (precision, precision)
+    lines = [
+        '<?xml version="1.0" encoding="UTF-8"?>',
+        '<gpx xmlns="http://www.topografix.com/GPX/1/1" version="1.1" creator="gopro-map-sync">',
+        "<trk><trkseg>",
+    ]
+    for point in all_points(gpx):
+        line = trkpt % (point.latitude, point.longitude)
+        if point.time:
+            time = point.time
+            if time.tzinfo:
+                time = time.astimezone(tz.tzutc())
+            line += "<time>%s.%03dZ</time>" % (
+                time.strftime("%Y-%m-%dT%H:%M:%S"),
+                time.microsecond // 1000,
+            )
+        if point.comment:
+            line += "<cmt>%s</cmt>" % (escape(point.comment))
+        lines.append(line + "</trkpt>")
+    lines += ["</trkseg></trk>", "</gpx>", ""]
+    return "\n".join(lines)
+
+
 #
 # Reads a file from a file or stdin.
 # Returns: (GPX object, points) tuple
@@ -51,15 +105,41 @@ def read(fname=None):
     Returns:
         [gpxpy.gpx.GPX, points] tuple
     """
-    if fname:
+    if not fname:
+        gpx = gpxpy.parse(sys.stdin)
+    elif _read_cache is None:
         with open(fname, "r") as f:
             gpx = gpxpy.parse(f)
     else:
-        gpx = gpxpy.parse(sys.stdin)
+        st = os.stat(fname)
+        key = (os.path.abspath(fname), st.st_mtime_ns, st.st_size)
+        if key in _read_cache:
+            _read_cache.move_to_end(key)
+            gpx = pickle.loads(_read_cache[key])
+        else:
+            with open(fname, "r") as f:
+                gpx = gpxpy.parse(f)
+            _read_cache[key] = pickle.dumps(gpx, pickle.HIGHEST_PROTOCOL)
+            if len(_read_cache) > _read_cache_size:
+                _read_cache.popitem(last=False)
 
     return gpx, all_points(gpx)
 
 
+_read_cache, _read_cache_size = None, 0
+
+
+def enable_read_cache(size):
+    """Makes read() keep the last size files it parsed in memory
+
+    Only useful in a long-running process, such as gpxd. A file is parsed
+    again if its modification time or size changed. Cached data is stored
+    pickled, so callers are free to modify what read() returns.
+    """
+    global _read_cache, _read_cache_size
+    _read_cache, _read_cache_size = OrderedDict(), size
+
+
 def all_points(gpx):
     """Returns all GPX points
 
@@ -88,6 +168,40 @@ def diff(p1, p2):
     return (p2.time - p1.time).total_seconds()
 
 
+EARTH_RADIUS = 6371.0088  # km
+
+
+def coords(points):
+    """Returns the latitudes and longitudes of GPX points as numpy arrays
+
+    Parameters:
+        points (gpxpy.gpx.GPXTrackPoint[]): an array of GPX points
+
+    Returns:
+        [lat, lng] tuple of numpy arrays, in radians
+    """
+    lat = np.radians(np.fromiter((p.latitude for p in points), float, len(points)))
+    lng = np.radians(np.fromiter((p.longitude for p in points), float, len(points)))
+    return lat, lng
+
+
+def haversine(lat1, lng1, lat2, lng2):
+    """Vectorized great-circle distance
+
+    Parameters:
+        lat1, lng1, lat2, lng2 (numpy arrays or floats): coordinates in radians
+
+    Returns:
+        Distance(s) in km. Within a few meters of dist() for the distances
+        gpxlib deals with, but orders of magnitude faster on arrays.
+    """
+    a = (
+        np.sin((lat2 - lat1) / 2) ** 2
+        + np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
 # --------------------------------------------------------------------------------
 #
 # gpxdup
@@ -165,6 +279,16 @@ def gpxdup(
 # --------------------------------------------------------------------------------
 DEFAULT_MAXDIST = 500  # meters
 DEFAULT_TOLERANCE = 1
+DEFAULT_CLEAN_ENGINE = "distance"
+CLEAN_ENGINES = ["distance", "speed"]
+DEFAULT_MAXSPEED = 100  # km/h
+DEFAULT_MAXACCEL = 10  # m/s^2
+DEFAULT_CLEAN_WINDOW = 1  # seconds on either side
+MIN_CLEAN_NEIGHBOURS = 5  # points on either side, however short the window
+SPEED_FACTOR = 5
+ACCEL_MADS = 50  # median absolute deviations above the median acceleration
+JUMP_MADS = 50  # median absolute deviations above the median step that are a jump
+MIN_DIFF = 0.001  # seconds
 
 
 #
@@ -199,6 +323,204 @@ def gpxclean(points, maxdist=DEFAULT_MAXDIST, tolerance=DEFAULT_TOLERANCE):
     return xpoints
 
 
+def _median_rows(a, edge):
+    """Row medians of a 2-D array whose NaNs are confined to the first and last edge rows"""
+    median = np.median(a, axis=1)
+    median[:edge] = np.nanmedian(a[:edge], axis=1)
+    median[-edge:] = np.nanmedian(a[-edge:], axis=1)
+    return median
+
+
+def bursts(points, maxspeed=DEFAULT_MAXSPEED):
+    """Finds runs of points that jump away from the track and back
+
+    Parameters:
+        points (gpxpy.gpx.GPXTrackPoint[]): an array of GPX points
+        maxspeed (float): speed in km/h above which a step is a jump
+
+    Returns:
+        An array of [start, end] tuples, one per burst: points[start:end]
+        disagree with the track around them.
+
+    A jump is a step between two consecutive points that is both faster than
+    maxspeed (raised to SPEED_FACTOR times the median step speed, as in
+    outliers()) and longer than GPS noise, i.e., JUMP_MADS median absolute
+    deviations above the median step. A burst starts after a jump and ends
+    with the first later jump after which the track continues where it would
+    have been without the burst: the point after the burst is less than half
+    the length of either jump away from where the local velocity (averaged
+    over MIN_CLEAN_NEIGHBOURS points before and after the burst) predicts it
+    to be. A burst can be any number of points long.
+    """
+    n = len(points)
+    if n < 3:
+        return []
+
+    lat, lng = coords(points)
+    t = np.fromiter((p.time.timestamp() for p in points), float, n)
+    steps = haversine(lat[:-1], lng[:-1], lat[1:], lng[1:])
+    dt = np.maximum(np.abs(np.diff(t)), MIN_DIFF)
+
+    speed_limit = max(maxspeed, SPEED_FACTOR * np.median(steps / dt * 3600))
+    median = np.median(steps)
+    noise = median + JUMP_MADS * np.median(np.abs(steps - median))
+    jumps = np.flatnonzero((steps > speed_limit * dt / 3600) & (steps > noise))
+
+    # local projection (km), to extrapolate positions
+    pos = np.column_stack(
+        (
+            (lng - np.mean(lng)) * np.cos(np.mean(lat)) * EARTH_RADIUS,
+            (lat - np.mean(lat)) * EARTH_RADIUS,
+        )
+    )
+    m = MIN_CLEAN_NEIGHBOURS
+
+    runs = []
+    after = -1
+    for idx, a in enumerate(jumps):
+        if a < after:
+            continue
+        for b in jumps[idx + 1 :]:
+            before, behind = max(a - m, 0), min(b + 1 + m, n - 1)
+            velocity = (
+                (pos[a] - pos[before]) / max(t[a] - t[before], MIN_DIFF)
+                + (pos[behind] - pos[b + 1]) / max(t[behind] - t[b + 1], MIN_DIFF)
+            ) / (int(before < a) + int(b + 1 < behind))
+            expected = pos[a] + velocity * (t[b + 1] - t[a])
+            if np.hypot(*(pos[b + 1] - expected)) < min(steps[a], steps[b]) / 2:
+                runs.append((int(a) + 1, int(b) + 1))
+                after = b + 1
+                break
+    return runs
+
+
+def outliers(
+    points,
+    maxspeed=DEFAULT_MAXSPEED,
+    maxaccel=DEFAULT_MAXACCEL,
+    window=DEFAULT_CLEAN_WINDOW,
+    runs=None,
+):
+    """Marks points that imply an implausible speed or acceleration
+
+    Parameters:
+        points (gpxpy.gpx.GPXTrackPoint[]): an array of GPX points
+        maxspeed (float): speed in km/h above which a point is an outlier
+        maxaccel (float): acceleration in m/s^2 above which a point is an outlier
+        window (float): seconds on either side to compare against
+        runs: bursts(points, maxspeed), if already known
+
+    Returns:
+        A numpy boolean array, True for each outlier point.
+
+    All points in bursts() are outliers. Of the other points, a point's speed
+    is the median of the speeds implied by moving between it and each of its
+    neighbours within the window, forward and backward. An outlier implies a
+    high speed to all of its neighbours, while a good point next to an
+    outlier only does so to some of them. Because neighbours on both sides
+    count, an outlier first point is caught as well. The window is converted
+    to a number of neighbours using the median time between points, so it
+    covers the same time at any sample rate, but it always includes at least
+    MIN_CLEAN_NEIGHBOURS neighbours on either side.
+
+    A point's acceleration is the difference between its speed and the
+    median speed of its neighbours, over the time span of the window.
+
+    In TimeWarp footage, GoPro timestamps imply speeds that are many times
+    too high, so maxspeed is raised to SPEED_FACTOR times the median speed of
+    the track if that is higher. Likewise, at high sample rates GPS noise
+    dominates the acceleration, so maxaccel is raised to ACCEL_MADS median
+    absolute deviations above the median acceleration if that is higher.
+    """
+    if window <= 0:
+        raise Exception("window must be positive")
+
+    mask = np.zeros(len(points), dtype=bool)
+    if runs is None:
+        runs = bursts(points, maxspeed=maxspeed)
+    for start, end in runs:
+        mask[start:end] = True
+
+    # judge the remaining points without the bursts in their window
+    keep = np.flatnonzero(~mask)
+    n = len(keep)
+    if n < 2:
+        return mask
+
+    lat, lng = coords([points[idx] for idx in keep])
+    t = np.fromiter((points[idx].time.timestamp() for idx in keep), float, n)
+    k = int(round(window / max(np.median(np.abs(np.diff(t))), MIN_DIFF)))
+    k = min(max(k, MIN_CLEAN_NEIGHBOURS), n - 1)
+
+    # implied speed (km/h) between each point and each neighbour in the window;
+    # columns [0, k) look backward, columns [k, 2 * k) forward
+    speeds = np.full((n, 2 * k), np.nan)
+    for j in range(1, k + 1):
+        xdist = haversine(lat[:-j], lng[:-j], lat[j:], lng[j:])
+        xdiff = np.maximum(np.abs(t[j:] - t[:-j]), MIN_DIFF)
+        speeds[:-j, k + j - 1] = speeds[j:, k - j] = xdist / xdiff * 3600
+    speed = _median_rows(speeds, k)
+
+    # acceleration (m/s^2) relative to the neighbours' speed, over the time
+    # span of the window, not a single step: the speeds are themselves
+    # measured over the window, and dividing their noise by a single step
+    # would flag good points on tracks with a high sample rate
+    neighbours = np.lib.stride_tricks.sliding_window_view(
+        np.pad(speed, k, constant_values=np.nan), 2 * k + 1
+    )
+    neighbours = np.delete(neighbours, k, axis=1)
+    idx = np.arange(n)
+    span = t[np.minimum(idx + k, n - 1)] - t[np.maximum(idx - k, 0)]
+    span = np.maximum(np.abs(span), MIN_DIFF)
+    accel = np.abs(speed - _median_rows(neighbours, k)) / 3.6 / span
+
+    speed_limit = max(maxspeed, SPEED_FACTOR * np.median(speed))
+    median = np.median(accel)
+    accel_limit = max(maxaccel, median + ACCEL_MADS * np.median(np.abs(accel - median)))
+    logging.debug(
+        "outliers: %d neighbours, speed limit %f km/h, acceleration limit %f m/s^2",
+        2 * k,
+        speed_limit,
+        accel_limit,
+    )
+
+    mask[keep] = (speed > speed_limit) | (accel > accel_limit)
+    return mask
+
+
+def gpxclean_speed(
+    points,
+    maxspeed=DEFAULT_MAXSPEED,
+    maxaccel=DEFAULT_MAXACCEL,
+    window=DEFAULT_CLEAN_WINDOW,
+):
+    """Removes the points marked by outliers()
+
+    Unlike gpxclean(), this never gives up on a track; bursts of outliers are
+    removed and reported.
+    """
+    runs = bursts(points, maxspeed=maxspeed)
+    for start, end in runs:
+        logging.info(
+            "gpxclean: removing burst of %d point(s) (%.1f seconds) at %s",
+            end - start,
+            diff(points[start], points[end - 1]),
+            points[start].time,
+        )
+
+    mask = outliers(
+        points, maxspeed=maxspeed, maxaccel=maxaccel, window=window, runs=runs
+    )
+    if mask.any():
+        logging.info(
+            "gpxclean: removed %d outlier point(s) in %d burst(s)",
+            np.count_nonzero(mask),
+            len(runs),
+        )
+
+    return [point for point, outlier in zip(points, mask) if not outlier]
+
+
 # --------------------------------------------------------------------------------
 #
 # gpxfill
@@ -354,7 +676,7 @@ def gpxcat(
 def gpxshift(points, value=None, last=False):
     # relative shift
     if value.startswith("+") or value.startswith("-"):
-        shift = datetime.timedelta(microseconds=int(value) * 1000)
+        shift = timedelta(microseconds=int(value) * 1000)
 
     # absolute shift
     else:
@@ -371,6 +693,160 @@ def gpxshift(points, value=None, last=False):
     return xpoints
 
 
+DEFAULT_OFFSET_STEP = 1  # seconds
+DEFAULT_MAX_STRETCH = 1
+OFFSET_EXCLUSION = 60  # seconds around the best offset to ignore for the runner-up
+MIN_OVERLAP = 0.5  # fraction of the shorter track that must overlap the other
+MAX_OFFSET_DISTANCE = 100  # meters; a match further apart than this is no match
+MIN_OFFSET_CONTRAST = 2  # runner_up must be this many times the distance
+
+
+def profile(points, origin, step=DEFAULT_OFFSET_STEP, stretch=1):
+    """Resamples a track to a regular time grid
+
+    Parameters:
+        points (gpxpy.gpx.GPXTrackPoint[]): an array of GPX points
+        origin ([lat, lng] tuple): origin of the local projection, in radians
+        step (float): grid spacing in seconds
+        stretch (float): time expansion factor, as in gpxcat()
+
+    Returns:
+        [start, channels] tuple, where start is the (stretched) timestamp of
+        the first sample and channels is a 3 x N numpy array: position east
+        and north of origin (km) and speed (km/h), sampled every step seconds.
+    """
+    lat, lng = coords(points)
+    t = np.fromiter((p.time.timestamp() for p in points), float, len(points))
+    t = t[0] + (t - t[0]) * stretch
+
+    # np.interp() needs increasing times
+    keep = np.concatenate(([True], t[1:] > np.maximum.accumulate(t)[:-1]))
+    t, lat, lng = t[keep], lat[keep], lng[keep]
+
+    grid = np.arange(t[0], t[-1], step)
+    x = np.interp(grid, t, (lng - origin[1]) * np.cos(origin[0])) * EARTH_RADIUS
+    y = np.interp(grid, t, lat - origin[0]) * EARTH_RADIUS
+    speed = np.hypot(np.diff(x, prepend=x[0]), np.diff(y, prepend=y[0])) / step * 3600
+    return t[0], np.vstack((x, y, speed))
+
+
+def _cross(a, b):
+    """For each lag l in [1 - len(a), len(b) - 1], sum(a[i] * b[i + l]) over
+    all i for which both exist, using FFT"""
+    n, m = len(a), len(b)
+    size = 1 << (n + m - 1).bit_length()
+    dot = np.fft.irfft(np.fft.rfft(b, size) * np.conj(np.fft.rfft(a, size)), size)
+    return np.concatenate((dot[size - n + 1 :], dot[:m]))
+
+
+def correlate(a, b):
+    """Returns the Pearson correlation of two equally long signals, or 0.0 if
+    either is flat"""
+    a = a - a.mean()
+    b = b - b.mean()
+    norm = np.sqrt(np.sum(a * a) * np.sum(b * b))
+    return float(np.clip(np.sum(a * b) / norm, -1, 1)) if norm > 1e-9 else 0.0
+
+
+def mismatch(a, b):
+    """Root mean square distance between two resampled tracks
+
+    Parameters:
+        a, b (numpy arrays): 2 x N positions as returned by profile()
+
+    Returns:
+        [distances, overlaps] tuple of numpy arrays with, for each lag l in
+        [1 - len(a), len(b) - 1] (sample i of a lines up with sample i + l of
+        b), the root mean square distance (km) between a and b over the
+        samples where they overlap, and the number of those samples.
+    """
+    n, m = a.shape[1], b.shape[1]
+    sq = _cross(np.sum(a * a, axis=0), np.ones(m))
+    sq += _cross(np.ones(n), np.sum(b * b, axis=0))
+    sq -= 2 * sum(_cross(x, y) for x, y in zip(a, b))
+    overlaps = np.rint(_cross(np.ones(n), np.ones(m)))
+    return np.sqrt(np.maximum(sq, 0) / np.maximum(overlaps, 1)), overlaps
+
+
+def find_offset(
+    points, ref_points, step=DEFAULT_OFFSET_STEP, max_stretch=DEFAULT_MAX_STRETCH
+):
+    """Finds the time shift that best aligns points with ref_points
+
+    Parameters:
+        points (gpxpy.gpx.GPXTrackPoint[]): the track to shift (e.g., GoPro)
+        ref_points (gpxpy.gpx.GPXTrackPoint[]): the reference track
+        step (float): resolution in seconds
+        max_stretch (int): also try gpxcat() stretch factors 2..max_stretch
+
+    Returns:
+        A dict with:
+            offset: seconds to add to the timestamps of points
+            stretch: the best stretch factor
+            distance: root mean square distance (m) between the tracks at offset
+            runner_up: the smallest distance (m) more than OFFSET_EXCLUSION
+                       seconds away from offset, or None
+            overlap: the fraction of the shorter track that overlaps the
+                     other at offset
+            correlation: correlation of the speed profiles at offset
+            confident: whether distance is at most MAX_OFFSET_DISTANCE and
+                       runner_up at least MIN_OFFSET_CONTRAST times distance
+
+        A distance far below runner_up and a correlation close to 1.0 mean a
+        confident match.
+
+    Both tracks are resampled to a common time grid, after which the distance
+    between them at every possible offset is computed at once with FFT, in
+    O(n log n). Either track may start or end first: the distance is taken
+    over the samples where they overlap, for every offset at which that is at
+    least MIN_OVERLAP of the shorter track.
+
+    In TimeWarp footage the GoPro's timestamps run too slowly, so unless the
+    track was stretched already it only lines up with the reference once
+    stretched by the TimeWarp factor; that's what max_stretch is for.
+    """
+    ref_lat, ref_lng = coords(ref_points)
+    origin = (np.mean(ref_lat), np.mean(ref_lng))
+    ref_start, ref = profile(ref_points, origin, step)
+
+    best = None
+    for stretch in range(1, max_stretch + 1):
+        start, track = profile(points, origin, step, stretch)
+        n, m = track.shape[1], ref.shape[1]
+        if min(n, m) < 2:
+            raise Exception("Track too short to find an offset")
+
+        distances, overlaps = mismatch(track[:2], ref[:2])
+        distances[overlaps < MIN_OVERLAP * min(n, m)] = np.inf
+        idx = int(np.argmin(distances))
+        logging.debug(
+            "stretch %d: distance %f km at lag %d", stretch, distances[idx], idx - n + 1
+        )
+
+        if best is None or distances[idx] * 1000 < best["distance"]:
+            exclusion = int(OFFSET_EXCLUSION / step)
+            rest = np.concatenate(
+                (distances[: max(0, idx - exclusion)], distances[idx + exclusion + 1 :])
+            )
+            rest = rest[np.isfinite(rest)]
+            lag = idx - n + 1
+            i, j = max(0, -lag), min(n, m - lag)
+            best = {
+                "offset": float(ref_start - start + lag * step),
+                "stretch": stretch,
+                "distance": float(distances[idx]) * 1000,
+                "runner_up": float(rest.min()) * 1000 if len(rest) else None,
+                "overlap": float(overlaps[idx]) / min(n, m),
+                "correlation": correlate(track[2, i:j], ref[2, i + lag : j + lag]),
+            }
+
+    best["confident"] = best["distance"] <= MAX_OFFSET_DISTANCE and (
+        best["runner_up"] is None
+        or best["runner_up"] >= MIN_OFFSET_CONTRAST * best["distance"]
+    )
+    return best
+
+
 # --------------------------------------------------------------------------------
 #
 # gpxtac
@@ -412,8 +888,11 @@ def find_pauses(ref_points, pause_snap=DEFAULT_PAUSE_SNAP):
         xdiff = diff(prev_point, point)
         if xdiff > PAUSE_THRESHOLD:
             logging.debug(
-                "There is a %f second pause at ref[%d] between %s and %s"
-                % (xdiff, idx - 1, str(prev_point.time), str(point.time))
+                "There is a %f second pause at ref[%d] between %s and %s",
+                xdiff,
+                idx - 1,
+                prev_point.time,
+                point.time,
             )
             pauses.append(idx - 1)
         prev_point = point
@@ -453,6 +932,17 @@ def snap_to_pause(pauses, ref_points, idx, pause_snap=DEFAULT_PAUSE_SNAP):
     return minidx
 
 
+_timezone_finder = None
+
+
+def timezone_finder():
+    """Returns a TimezoneFinder, which is expensive to create, so it is shared"""
+    global _timezone_finder
+    if _timezone_finder is None:
+        _timezone_finder = TimezoneFinder()
+    return _timezone_finder
+
+
 def create_modified_point(point, time, to_zone_str, speed_in_ms, cumulative_dist):
     """Creates a new GPX point with an informative <cmt> block
 
@@ -471,8 +961,9 @@ def create_modified_point(point, time, to_zone_str, speed_in_ms, cumulative_dist
 
     # force a timezone lookup for this point
     if not to_zone_str:
-        tf = TimezoneFinder()
-        to_zone_str = tf.timezone_at(lng=point.longitude, lat=point.latitude)
+        to_zone_str = timezone_finder().timezone_at(
+            lng=point.longitude, lat=point.latitude
+        )
 
     # convert point time to timezone
     to_zone = tz.gettz(to_zone_str)
@@ -486,8 +977,8 @@ def create_modified_point(point, time, to_zone_str, speed_in_ms, cumulative_dist
         cumulative_dist,
         speed_in_kmh,
     )
-    logging.debug("segment_points.append(%s)" % (str(point)))
-    logging.debug("comment:\n%s" % (str(point.comment)))
+    logging.debug("segment_points.append(%s)", point)
+    logging.debug("comment:\n%s", point.comment)
 
     return point
 
@@ -557,7 +1048,11 @@ def find_closest(p, refs, start, radius=DEFAULT_RADIUS, search="best_in_radius")
     if not radius:
         radius = DEFAULT_RADIUS
 
-    logging.debug("find_closest, radius = %f" % (radius))
+    # find_closest() is called for every point and inspects many candidates;
+    # don't even call into logging unless it is going to log something
+    debug = logging.root.isEnabledFor(logging.DEBUG)
+    if debug:
+        logging.debug("find_closest, radius = %f", radius)
 
     in_radius = False
     mindist, minidx = None, len(refs) - 1
@@ -565,55 +1060,394 @@ def find_closest(p, refs, start, radius=DEFAULT_RADIUS, search="best_in_radius")
     for idx in range(start, len(refs)):
         ref = refs[idx]
         xdist = dist(p, ref)
-        logging.debug("find_closest idx %d, d = %f" % (idx, xdist))
+        if debug:
+            logging.debug("find_closest idx %d, d = %f", idx, xdist)
 
         # we got within radius distance of point p
         if xdist < RADIUS_MIN or xdist < radius:
             if not in_radius:
                 in_radius = True
-                logging.debug("xdist < radius, in_radius")
+                if debug:
+                    logging.debug("xdist < radius, in_radius")
             if search == "first_in_radius":
-                logging.debug(
-                    "xdist < radius, search == 'first' returning with idx %d " % (idx)
-                )
+                if debug:
+                    logging.debug(
+                        "xdist < radius, search == 'first' returning with idx %d ", idx
+                    )
                 return idx
 
         # we left the radius after having been in it
         elif in_radius:
-            logging.debug("left radius")
+            if debug:
+                logging.debug("left radius")
             if search == "last_in_radius":
-                logging.debug(
-                    "left radius, search == 'last', returning with %d" % (idx - 1)
-                )
+                if debug:
+                    logging.debug(
+                        "left radius, search == 'last', returning with %d", idx - 1
+                    )
                 return idx - 1
             elif search == "best_in_radius":
-                logging.debug(
-                    "left radius, search == 'best_abort', returning with %d" % (minidx)
-                )
+                if debug:
+                    logging.debug(
+                        "left radius, search == 'best_abort', returning with %d", minidx
+                    )
                 return minidx
             in_radius = False
 
         if mindist is None or xdist < mindist:
             mindist = xdist
             minidx = idx
-            logging.debug("new mindist = %f at idx %d" % (xdist, idx))
+            if debug:
+                logging.debug("new mindist = %f at idx %d", xdist, idx)
 
         if xdist > RADIUS_MIN and xdist > (radius * RADIUS_TOLERANCE):
-            logging.debug("out of radius tolerance; abort")
+            if debug:
+                logging.debug("out of radius tolerance; abort")
             break
 
-    logging.debug("return minidx %d " % (minidx))
+    if debug:
+        logging.debug("return minidx %d ", minidx)
     return minidx
 
 
 LOOKBACK = 10
 
+DEFAULT_ENGINE = "greedy"
+ENGINES = ["greedy", "dtw"]
+DEFAULT_DTW_BAND = 250  # reference points on either side of the band center
+DTW_ENDPOINTS = 10  # points used to locate the start and end on the reference
+DTW_GAP = PAUSE_THRESHOLD  # seconds without points that split a track into pieces
+
+
+def distance_along(lat, lng):
+    """Returns the cumulative distance (in km) along a track, as a numpy array"""
+    return np.concatenate(
+        ([0.0], np.cumsum(haversine(lat[:-1], lng[:-1], lat[1:], lng[1:])))
+    )
+
+
+def dtw_pieces(points, lat, lng):
+    """Splits a track where it was not recorded, e.g., between two GoPro clips
+
+    Parameters:
+        points (gpxpy.gpx.GPXTrackPoint[]): the track
+        lat, lng: coords(points)
+
+    Returns:
+        An array of [start, end] tuples of indices into points[], one per piece
+
+    A piece ends where the next point is more than DTW_GAP seconds or
+    DEFAULT_MAXDIST meters away. A piece of fewer than DTW_ENDPOINTS points,
+    such as a single outlier, is not worth its own band and is merged into the
+    piece before it.
+    """
+    n = len(points)
+    steps = haversine(lat[:-1], lng[:-1], lat[1:], lng[1:])
+    gaps = steps > DEFAULT_MAXDIST / 1000
+    if all(p.time for p in points):
+        t = np.array([p.time.timestamp() for p in points])
+        gaps |= np.diff(t) > DTW_GAP
+
+    pieces = []
+    bounds = [0] + (np.flatnonzero(gaps) + 1).tolist() + [n]
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        if pieces and min(end - start, pieces[-1][1] - pieces[-1][0]) < DTW_ENDPOINTS:
+            pieces[-1] = (pieces[-1][0], end)
+        else:
+            pieces.append((start, end))
+    return pieces
+
+
+def dtw_center(cum, ref_cum, start, end):
+    """Returns, for each point of a track, the reference point that is as far
+    along ref_points[start:end] as the point is along the track
+
+    Parameters:
+        cum: distance_along() the track
+        ref_cum: distance_along() the reference track
+        start, end (int): indices into the reference track
+    """
+    frac = cum / cum[-1] if cum[-1] else np.zeros(len(cum))
+    return np.searchsorted(
+        ref_cum, ref_cum[start] + frac * (ref_cum[end] - ref_cum[start])
+    )
+
+
+def dtw_span(lat, lng, cum, ref_lat, ref_lng, ref_cum, first=0, t=None, ref_t=None):
+    """Finds the stretch of the reference track that a track covers
+
+    Parameters:
+        lat, lng: coords() of the track
+        cum: distance_along() the track
+        ref_lat, ref_lng: coords() of the reference track
+        ref_cum: distance_along() the reference track
+        first (int): the stretch starts at or after ref_points[first]
+        t, ref_t: timestamps (in seconds) of both tracks, or None
+
+    Returns:
+        [start, end] tuple of indices into the reference track
+
+    A stretch starts at a reference point close to the start of the track and
+    ends at the reference point close to the end of the track whose distance
+    along the reference best agrees with the length of the track. Both use the
+    median over DTW_ENDPOINTS points, so a single outlier does not throw them
+    off.
+
+    The reference may pass the start of the track more than once, e.g., on
+    both legs of an out-and-back route or on every lap of a circuit. Each pass
+    is a candidate stretch and the track is compared to each along the
+    diagonal (see dtw_center()). Of the stretches that fit within RADIUS_MIN
+    of the best, the one that starts closest in time wins if the track starts
+    while the reference was recorded, and otherwise the earliest.
+    """
+    n = len(lat)
+    head, tail = slice(0, DTW_ENDPOINTS), slice(max(0, n - DTW_ENDPOINTS), n)
+    d = haversine(
+        lat[head, None], lng[head, None], ref_lat[None, first:], ref_lng[None, first:]
+    )
+    near = d <= d.min(axis=1)[:, None] + RADIUS_MIN
+    cols = np.flatnonzero(near.any(axis=0))
+
+    spans = []
+    for run in np.split(cols, np.flatnonzero(np.diff(cols) > 1) + 1):
+        hits = near[:, run[0] : run[-1] + 1]
+        hit = np.argmax(hits, axis=1)[hits.any(axis=1)]
+        start = first + int(run[0] + np.median(hit))
+
+        d = haversine(
+            lat[tail, None],
+            lng[tail, None],
+            ref_lat[None, start:],
+            ref_lng[None, start:],
+        )
+        near_end = d <= d.min(axis=1)[:, None] + RADIUS_MIN
+        agreement = np.abs(ref_cum[None, start:] - ref_cum[start] - cum[tail, None])
+        end = start + int(
+            np.median(np.argmin(np.where(near_end, agreement, np.inf), axis=1))
+        )
+
+        center = dtw_center(cum, ref_cum, start, end)
+        cost = np.mean(haversine(lat, lng, ref_lat[center], ref_lng[center]))
+        spans.append((start, end, cost))
+    logging.debug("dtw_span: candidates %s", spans)
+
+    best = min(cost for _, _, cost in spans)
+    spans = [span for span in spans if span[2] <= best + RADIUS_MIN]
+    if t is not None and ref_t is not None and ref_t[0] <= t[0] <= ref_t[-1]:
+        spans.sort(key=lambda span: abs(ref_t[span[0]] - t[0]))
+    return spans[0][:2]
+
+
+def dtw_match(points, ref_points, band=DEFAULT_DTW_BAND):
+    """
+    Aligns a GPX track to a reference track using banded dynamic time warping.
+
+    Parameters:
+        points (gpxpy.gpx.GPXTrackPoint[]): the track to align (e.g., GoPro)
+        ref_points (gpxpy.gpx.GPXTrackPoint[]): the reference track
+        band (int): half-width of the band, in reference points
+
+    Returns:
+        An array with, for each point in points[], an index into ref_points[].
+        The indices are non-decreasing and together minimize the sum of the
+        distances between each point and its match.
+
+    Unlike find_closest(), which commits to a match point by point, this
+    considers the whole track at once, so it does not get lost when the
+    tracks briefly diverge or when a track crosses itself.
+
+    Each point in points[] matches exactly one reference point and the match
+    may skip over reference points, so the accumulated cost of a cell is its
+    distance plus the running minimum over the previous row. That makes each
+    row a handful of numpy operations.
+
+    The band follows the diagonal in distance space: the i-th point is
+    expected to be as far along the matched stretch of ref_points[] (see
+    dtw_span()) as it is along points[]. A track concatenated from several
+    clips does not cover the reference continuously, so each piece (see
+    dtw_pieces()) gets its own stretch, at or after the stretch of the piece
+    before it. Memory use is len(points) * (2 * band + 1) back pointers.
+    """
+    n, m = len(points), len(ref_points)
+    lat, lng = coords(points)
+    ref_lat, ref_lng = coords(ref_points)
+    ref_cum = distance_along(ref_lat, ref_lng)
+
+    # outliers should not stretch the track
+    steps = np.minimum(
+        haversine(lat[:-1], lng[:-1], lat[1:], lng[1:]), DEFAULT_MAXDIST / 1000
+    )
+    cum = np.concatenate(([0.0], np.cumsum(steps)))
+
+    t = ref_t = None
+    if all(p.time for p in points) and all(p.time for p in ref_points):
+        t = np.array([p.time.timestamp() for p in points])
+        ref_t = np.array([p.time.timestamp() for p in ref_points])
+
+    center = np.empty(n, dtype=np.int64)
+    first = 0
+    for lo, hi in dtw_pieces(points, lat, lng):
+        piece_cum = cum[lo:hi] - cum[lo]
+        start, end = dtw_span(
+            lat[lo:hi],
+            lng[lo:hi],
+            piece_cum,
+            ref_lat,
+            ref_lng,
+            ref_cum,
+            first,
+            None if t is None else t[lo:hi],
+            ref_t,
+        )
+        logging.debug(
+            "dtw_match: points[%d:%d] on ref[%d:%d], band %d", lo, hi, start, end, band
+        )
+        center[lo:hi] = dtw_center(piece_cum, ref_cum, start, end)
+        first = end
+
+    width = min(2 * band + 1, m)
+    lo = np.clip(center - band, 0, m - width)
+
+    offsets = np.arange(width)
+    back = np.empty((n, width), dtype=np.int32)
+    cost = haversine(
+        lat[0], lng[0], ref_lat[lo[0] : lo[0] + width], ref_lng[lo[0] : lo[0] + width]
+    )
+    for i in range(1, n):
+        # best predecessor of each cell in the previous row: the running
+        # minimum and the (latest) position where it occurs
+        run_min = np.minimum.accumulate(cost)
+        run_arg = np.maximum.accumulate(np.where(cost == run_min, offsets, 0))
+
+        # the cells of this row, in coordinates of the previous row
+        prev = np.minimum(offsets + (lo[i] - lo[i - 1]), width - 1)
+
+        window = slice(lo[i], lo[i] + width)
+        cost = run_min[prev] + haversine(
+            lat[i], lng[i], ref_lat[window], ref_lng[window]
+        )
+        back[i] = lo[i - 1] + run_arg[prev]
+
+    matches = np.empty(n, dtype=np.int64)
+    matches[-1] = lo[-1] + np.argmin(cost)
+    for i in range(n - 1, 0, -1):
+        matches[i - 1] = back[i, matches[i] - lo[i]]
+
+    return matches.tolist()
+
+
+def alignment_cost(points, ref_points, alignment):
+    """Returns the mean distance (in meters) between points and their matches in ref_points"""
+    lat, lng = coords(points)
+    ref_lat, ref_lng = coords([ref_points[idx] for idx in alignment])
+    return float(np.mean(haversine(lat, lng, ref_lat, ref_lng))) * 1000
+
+
+def compare_engines(
+    points, ref_points, force_timezone=False, pause_snap=DEFAULT_PAUSE_SNAP
+):
+    """Runs gpxcomment with each engine in ENGINES
+
+    Parameters:
+        points, ref_points, force_timezone, pause_snap: see gpxcomment()
+
+    Returns:
+        An array of {engine, seconds, cost} dicts, where cost is the
+        alignment_cost() of the engine's final (i.e., pause snapped) matches.
+    """
+    report = []
+    for engine in ENGINES:
+        xpoints = copy.deepcopy(points)
+        started = timer.perf_counter()
+        _, alignment = _gpxcomment(
+            xpoints, ref_points, force_timezone, pause_snap, engine, None
+        )
+        report.append(
+            {
+                "engine": engine,
+                "seconds": timer.perf_counter() - started,
+                "cost": alignment_cost(xpoints, ref_points, alignment),
+            }
+        )
+    return report
+
+
+def gpxcomment(
+    points,
+    ref_points,
+    force_timezone=False,
+    pause_snap=DEFAULT_PAUSE_SNAP,
+    engine=DEFAULT_ENGINE,
+    trace=None,
+):
+    """Annotates points with a <cmt> block based on ref_points
+
+    Parameters:
+        points (gpxpy.gpx.GPXTrackPoint[]): the track to annotate (e.g., GoPro)
+        ref_points (gpxpy.gpx.GPXTrackPoint[]): the reference track
+        force_timezone (bool): look up the timezone of every point
+        pause_snap (int): snap to pauses within this many meters
+        engine (string): one of ENGINES
+        trace (string): optional file name; see write_trace()
+
+    Returns:
+        An array of GPX points
+    """
+    with open(trace, "w") if trace else contextlib.nullcontext() as trace_f:
+        xpoints, _ = _gpxcomment(
+            points, ref_points, force_timezone, pause_snap, engine, trace_f
+        )
+    return xpoints
+
+
+def write_trace(f, pidx, match, snap_idx, idx, xdist, pause_idx, buffered):
+    """Writes one gpxcomment match record to f as a line of JSON
+
+    Fields:
+        pidx: index of the point
+        match: index in the reference found by the engine
+        snap: index in the reference of the nearest pause start, see snap_to_pause()
+        idx: index in the reference the point was eventually matched to
+        dist: distance in meters between the point and ref[idx]
+        pause: index in the array of pauses if in a pause, otherwise null
+        buffered: whether the point was buffered to be spread over the pause
+    """
+    f.write(
+        json.dumps(
+            {
+                "pidx": pidx,
+                "match": match,
+                "snap": snap_idx,
+                "idx": idx,
+                "dist": round(xdist * 1000, 1),
+                "pause": pause_idx,
+                "buffered": buffered,
+            },
+            separators=(",", ":"),
+        )
+        + "\n"
+    )
+
+
+def _gpxcomment(points, ref_points, force_timezone, pause_snap, engine, trace_f):
+    if engine not in ENGINES:
+        raise Exception("Unknown gpxcomment engine %s" % (engine))
+
+    # with the dtw engine all matches are known up front; the greedy engine
+    # finds them one by one with find_closest()
+    matches = dtw_match(points, ref_points) if engine == "dtw" else None
 
-def gpxcomment(points, ref_points, force_timezone=False, pause_snap=DEFAULT_PAUSE_SNAP):
     # build an array of indices in ref_points[] that correspond to the start of
     # a pause
     pauses = find_pauses(ref_points, pause_snap=pause_snap)
-    logging.debug("Pauses = " + str(pauses))
+    logging.debug("Pauses = %s", pauses)
+
+    # the loop below runs for every point; skip building debug messages (and
+    # the distances that go into them) unless they are logged
+    debug = logging.root.isEnabledFor(logging.DEBUG)
+
+    # progress is logged whenever another percent of points is done
+    progress = None
 
     # as we traverse points and we match to a pause, pause_idx is the index in
     # pauses[] currently in, note that ref_points[pauses[pause_idx]] is the
@@ -647,54 +1481,61 @@ def gpxcomment(points, ref_points, force_timezone=False, pause_snap=DEFAULT_PAUS
     # look up timezone of first point
     to_zone_str = None
     if not force_timezone:
-        tf = TimezoneFinder()
-        to_zone_str = tf.timezone_at(lng=points[0].longitude, lat=points[0].latitude)
-
-    xpoints, processed_pauses = [], []
-    for pidx, point in enumerate(points):
-        logging.debug(
-            "Processing pidx %d, point %s, prev_idx = %s"
-            % (pidx, str(point), str(prev_idx))
+        to_zone_str = timezone_finder().timezone_at(
+            lng=points[0].longitude, lat=points[0].latitude
         )
 
-        # distance of previous point/reference match
-        prev_dist = None
-        if pidx > 0:
-            prev_dist = dist(points[pidx - 1], ref_points[prev_idx])
+    xpoints, processed_pauses, alignment = [], [], []
+    for pidx, point in enumerate(points):
+        if debug:
+            logging.debug(
+                "Processing pidx %d, point %s, prev_idx = %s", pidx, point, prev_idx
+            )
 
-        # find the best distance match; be willing to match to the past, though
-        # not further back than idx-LOOKBACK, and certainly not beyond the
-        # 0-index.
-        idx = find_closest(
-            point, ref_points, max(0, backstop_idx, idx - LOOKBACK), prev_dist
-        )
+        if matches is not None:
+            idx = matches[pidx]
+        else:
+            # distance of previous point/reference match
+            prev_dist = None
+            if pidx > 0:
+                prev_dist = dist(points[pidx - 1], ref_points[prev_idx])
+
+            # find the best distance match; be willing to match to the past,
+            # though not further back than idx-LOOKBACK, and certainly not
+            # beyond the 0-index.
+            idx = find_closest(
+                point, ref_points, max(0, backstop_idx, idx - LOOKBACK), prev_dist
+            )
 
         # possibly snap it to the next pause
         snap_idx = snap_to_pause(pauses, ref_points, idx, pause_snap=pause_snap)
-        logging.debug(
-            "idx %d (dist = %f), snap_idx %d (dist = %f)"
-            % (
+        match = idx
+        if debug:
+            logging.debug(
+                "idx %d (dist = %f), snap_idx %d (dist = %f)",
                 idx,
                 dist(point, ref_points[idx]),
                 snap_idx,
                 dist(point, ref_points[snap_idx]),
             )
-        )
 
         # don't snap to a pause if a) already in a pause or b) this pause has
         # already been snapped to previously
         if snap_idx in processed_pauses and not pause_start_at:
-            logging.debug(
-                "Skipping snap_idx %d because already processed in %s"
-                % (snap_idx, str(processed_pauses))
-            )
+            if debug:
+                logging.debug(
+                    "Skipping snap_idx %d because already processed in %s",
+                    snap_idx,
+                    processed_pauses,
+                )
 
         # snap to this pause
         else:
             idx = snap_idx
-            logging.debug(
-                "idx -> snap_idx %d, dist = %f" % (idx, dist(point, ref_points[idx]))
-            )
+            if debug:
+                logging.debug(
+                    "idx -> snap_idx %d, dist = %f", idx, dist(point, ref_points[idx])
+                )
 
         # we entered or are (still) in a pause
         if idx in pauses:
@@ -711,8 +1552,11 @@ def gpxcomment(points, ref_points, force_timezone=False, pause_snap=DEFAULT_PAUS
                 pause_end_at = ref_points[pauses[pause_idx] + 1].time
                 pause_duration = (pause_end_at - pause_start_at).total_seconds()
                 logging.debug(
-                    "Start of pause_idx %d, pause at %s, end of pause %s, duration %d "
-                    % (pause_idx, pause_start_at, pause_end_at, pause_duration)
+                    "Start of pause_idx %d, pause at %s, end of pause %s, duration %d ",
+                    pause_idx,
+                    pause_start_at,
+                    pause_end_at,
+                    pause_duration,
                 )
 
             # we are entering a new pause, so we need to "glue" this new pause
@@ -723,24 +1567,29 @@ def gpxcomment(points, ref_points, force_timezone=False, pause_snap=DEFAULT_PAUS
                 pause_end_at = ref_points[pauses[pause_idx] + 1].time
                 pause_duration = (pause_end_at - pause_start_at).total_seconds()
                 logging.debug(
-                    "Started consecutive pause_idx %d, still started pause at %s, new end of pause %s, new duration %d "
-                    % (pause_idx, pause_start_at, pause_end_at, pause_duration)
+                    "Started consecutive pause_idx %d, still started pause at %s, "
+                    "new end of pause %s, new duration %d ",
+                    pause_idx,
+                    pause_start_at,
+                    pause_end_at,
+                    pause_duration,
                 )
 
-            logging.debug(
-                "idx = %d, dist = %f, pause_idx = %s"
-                % (idx, dist(point, ref_points[idx]), pause_idx)
-            )
+            if debug:
+                logging.debug(
+                    "idx = %d, dist = %f, pause_idx = %s",
+                    idx,
+                    dist(point, ref_points[idx]),
+                    pause_idx,
+                )
             backstop_idx = pause_idx + 1
 
         # came out of pause; now we know how long the pause was
         elif pause_start_at:
             logging.debug(
-                "Came out of pause; buffered points = "
-                + str(len(pause_points))
-                + " over "
-                + str(pause_duration)
-                + " seconds "
+                "Came out of pause; buffered points = %d over %s seconds ",
+                len(pause_points),
+                pause_duration,
             )
 
             # add all the buffered points while smoothing out the paused time
@@ -751,7 +1600,8 @@ def gpxcomment(points, ref_points, force_timezone=False, pause_snap=DEFAULT_PAUS
                         * buffered_idx
                     )
                 )
-                logging.debug("Fake time for buffered point: %s" % (time))
+                if debug:
+                    logging.debug("Fake time for buffered point: %s", time)
                 mpoint = create_modified_point(
                     buffered_point, time, to_zone_str, 0, cumulative_dist
                 )
@@ -759,23 +1609,47 @@ def gpxcomment(points, ref_points, force_timezone=False, pause_snap=DEFAULT_PAUS
             pause_start_at = None
             pause_points = []
 
+        alignment.append(idx)
+
+        if trace_f:
+            write_trace(
+                trace_f,
+                pidx,
+                match,
+                snap_idx,
+                idx,
+                dist(point, ref_points[idx]),
+                pause_idx if pause_start_at else None,
+                bool(pause_start_at),
+            )
+
         # while in pause, don't write to output; we are waiting to find out where the pause stops
         if pause_start_at:
-            logging.debug("Pause buffering pidx %03d" % (pidx))
+            if debug:
+                logging.debug("Pause buffering pidx %03d", pidx)
             pause_points.append(point)
             continue
 
-        logging.info(
-            "gpxcomment: %05d / %05d (%02d%%) => %05d: dist %f @ %s"
-            % (
+        if debug:
+            logging.debug(
+                "gpxcomment: %05d / %05d => %05d: dist %f @ %s",
                 pidx,
                 len(points),
-                (((pidx + 1) / len(points)) * 100),
                 idx,
                 dist(point, ref_points[idx]),
                 ref_points[idx].time,
             )
-        )
+        percent = ((pidx + 1) * 100) // len(points)
+        if percent != progress:
+            progress = percent
+            logging.info(
+                "gpxcomment: %05d / %05d (%02d%%) => %05d @ %s",
+                pidx,
+                len(points),
+                percent,
+                idx,
+                ref_points[idx].time,
+            )
 
         # calculate speed if not specified
         # do it the simple way, but possible to include earth's
@@ -802,4 +1676,4 @@ def gpxcomment(points, ref_points, force_timezone=False, pause_snap=DEFAULT_PAUS
         )
         xpoints.append(mpoint)
 
-    return xpoints
+    return xpoints, alignment